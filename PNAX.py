@@ -1,33 +1,64 @@
 import pyvisa
+import asyncio
+import threading
 import numpy as np
-import time
 from datetime import datetime
-import sys
 import pandas as pd
 import os
 
 
 class PNAX():
+    # Precompiled SCPI templates for the frequently called setters
+    _CMD_FREQ = "SENS:FREQ:STAR %s;STOP %s;CENT %s;SPAN %s;CW %s"
+    _CMD_POW = "SOUR:POW1 %s"
+
+    # Row layout of the marker readouts collected by get_all_marker_data
+    _MARKER_DTYPE = np.dtype([('Marker', 'i2'), ('Trace', 'i2'), ('X', 'f8'), ('Y', 'f8')])
+
+    # VISA resource manager shared by all instances, created on first connect
+    _rm = None
+
     def __init__(self, ip = None):
 
-        self.rm = pyvisa.ResourceManager()
-        self.channels_open = np.array([])
+        self.rm = None
+        self.channels_open = set()
         self.pna = None
         self.ip = ip
+        self._io_lock = threading.Lock()  # Serializes get_data_output_async calls on this instance
+
+    def __enter__(self):
+        """
+        Connects on entering a with block, the connection is closed again on leaving it
+        """
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.disconnect_pna()
 
     def connect(self):
         """
         Makes a connection with the given IP address using pyvisa resource manager
-        If error occurs, quits the code
+        If error occurs, the pyvisa error is raised to the caller
         """
 
+        if PNAX._rm is None:
+            PNAX._rm = pyvisa.ResourceManager()
+        self.rm = PNAX._rm
+
         try:
             self.pna = self.rm.open_resource(f'TCPIP0::{self.ip}::inst0::INSTR')
+            self.pna.chunk_size = 4 * 1024 * 1024  # 4 MB reads, one read per trace or screenshot
+            self.pna.read_termination = '\n'
+            self.pna.write_termination = '\n'
+            self.pna.timeout = 30000  # Set timeout to 30 seconds
             print(f"Connected on {self.ip}")
-        except pyvisa.VisaIOError as e:
+        except Exception as e:
             print(e.args)
             print("Error connecting")
-            sys.exit(0)
+            # Close the session if it was opened before the error so it does not leak
+            self.disconnect_pna()
+            raise
 
         return 0
 
@@ -35,8 +66,7 @@ class PNAX():
         """
         Prints the ID of the instrument that is connected
         """
-        self.pna.write("*IDN?")
-        print(self.pna.read())
+        print(self.pna.query("*IDN?"))
         return 0
 
     def clear_measurements(self):
@@ -44,8 +74,8 @@ class PNAX():
         Clears all the measurements present on teh window
         '''
 
-        self.pna.write(f"CALC:PAR:DEL:ALL")
-        self.channels_open = np.array([])
+        self.pna.write("CALC:PAR:DEL:ALL")
+        self.channels_open = set()
 
     def pna_reset(self):
         """
@@ -64,11 +94,8 @@ class PNAX():
         cw_freq: the CW signal frequency
 
         """
-        self.pna.write(f"SENS:FREQ:STAR {start_freq}")
-        self.pna.write(f"SENS:FREQ:STOP {stop_freq}")
-        self.pna.write(f"SENS:FREQ:CENT {center_freq}")
-        self.pna.write(f"SENS:FREQ:SPAN {span}")
-        self.pna.write(f"SENS:FREQ:CW {cw_freq}")
+        # Single compound command, one VISA transaction for all five settings
+        self.pna.write(self._CMD_FREQ % (start_freq, stop_freq, center_freq, span, cw_freq))
 
         return 0
 
@@ -76,46 +103,45 @@ class PNAX():
         """
         Output power is on
         """
-        self.pna.write(f"OUTP ON")
+        self.pna.write("OUTP ON")
 
     def channel_power_set_OFF(self):
         """
         Output power is off
         """
-        self.pna.write(f"OUTP OFF")
+        self.pna.write("OUTP OFF")
 
     def set_power(self, power):
         """
         Set the power level
         """
-        self.pna.write(f"SOUR:POW1 {power}")
+        self.pna.write(self._CMD_POW % power)
 
     def query_freq_start(self):
         """
         Query the system with start frequency
         """
-        self.pna.write(f"SENS:OFFS:STAR?")
-        print(self.pna.read())
+        print(self.pna.query("SENS:OFFS:STAR?"))
 
     def query_freq_stop(self):
         """
         Query the system with stop frequency
         """
-        self.pna.write(f"SENS:OFFS:STOP?")
-        print(self.pna.read())
+        print(self.pna.query("SENS:OFFS:STOP?"))
 
     def set_marker(self, trigger):
         if trigger:
-            self.pna.write(f"DISP:WIND:ANN:MARK:STAT ON")
-            self.pna.write(f"CALC1: MARK1:MAX: PEAK")
-            self.pna.write(":INIT:IMM;*WAI")
+            self.pna.write("DISP:WIND:ANN:MARK:STAT ON")
+            self.pna.write("CALC1:MARK1:MAX:PEAK")
+            self.pna.write(":INIT:IMM")
+            self.pna.query("*OPC?")
             sig_dbm = self.pna.query(":CALC1:MARK1:Y?")
             sig_hz = self.pna.query(":CALC1:MARK1:X?")
         else:
-            self.pna.write(f"DISP:WIND:ANN:MARK:STAT OFF")
+            self.pna.write("DISP:WIND:ANN:MARK:STAT OFF")
 
     def marker(self, x_axis, y_axis, on=True):
-        self.pna.write(f"CALC:MARK:ON")
+        self.pna.write("CALC:MARK:ON")
         x_value = self.pna.write(f"CALC:MARK:X {x_axis}")
         y_value = self.pna.write(f"CALC:MARK:Y {y_axis}")
         print(x_value, y_value)
@@ -127,121 +153,189 @@ class PNAX():
         instr_path: give only the folder path you want, C:\\Temp\\Screenshots  (no need file name)
         pc_path: give the pc path you want to save at, C:\\Users\\Screenshots (no need file name)
         """
+        timeout = None
         try:
+            # Increase the timeout setting for the capture and for reading the file
+            timeout = self.pna.timeout
+            self.pna.timeout = 60000  # Set timeout to 60 seconds
+
             # Initiate the screenshot capture
             self.pna.write(rf":MMEM:STOR:IMAG '{instr_path}/{file_name}'")
 
             # Wait for the instrument to complete the screenshot capture
-            time.sleep(10)
+            self.pna.query("*OPC?")
 
             # Check if the file exists on the instrument
-            self.pna.write(rf":MMEM:CAT? '{instr_path}'")
-            file_catalog = self.pna.read()
+            file_catalog = self.pna.query(rf":MMEM:CAT? '{instr_path}'")
 
             if file_name not in file_catalog:
                 raise Exception(f"The file {file_name} was not found in the directory {instr_path} on the instrument.")
 
-            # Increase the timeout setting for reading the file
-            self.pna.timeout = 60000  # Set timeout to 60 seconds
-
-            # Read the file from the instrument in chunks to avoid timeout
-            self.pna.write(rf"MMEM:TRAN? '{instr_path}/{file_name}'")
-
-            screenshot_data = b""
-            chunk_size = 1024  # 1 KB chunks
-
-            while True:
-                chunk = self.pna.read_raw(chunk_size)
-                screenshot_data += chunk
-                if len(chunk) < chunk_size:
-                    break
-
-            # Save the screenshot to local PC
+            # Read the file from the instrument as a single definite-length binary block
+            # and write it straight to the local PC without keeping a copy around
             pc_file_name = os.path.join(pc_path, file_name)
             with open(pc_file_name, 'wb') as file:
-                file.write(screenshot_data)
+                file.write(self.pna.query_binary_values(rf"MMEM:TRAN? '{instr_path}/{file_name}'", datatype='B',
+                                                        container=bytes, header_fmt='ieee'))
 
             print(f"Screenshot saved successfully at {pc_file_name}")
 
         except Exception as e:
             print(f"An error occurred: {e}")
 
+        finally:
+            # Restore the timeout used by the other calls
+            if timeout is not None:
+                self.pna.timeout = timeout
+
 
 
-    def get_data_output(self, param, start_freq, stop_freq, number_of_points):
+    def get_data_output(self, param, start_freq, stop_freq, number_of_points, binary=True):
         """
         param: S11, S21, S43, etc
         start_freq : start freq of the measurement
         stop_freq: stop freq of the measurement
         number of points: total number of pints between the start and stop frequency
+        binary: transfer the data as a binary block, set False for ASCII on older firmware
         """
 
-        self.pna.write("*RST")  # Reset the instrument
-        self.pna.write("SYST:PRES")  # Preset the system
-        self.pna.write(f"CALC:PAR:DEF 'Meas1', {param}")  # Define measurement parameter
-        self.pna.write("DISP:WIND:TRAC:FEED 'Meas1'")  # Display the trace
+        self.pna.write("*RST;:SYST:PRES")  # Reset the instrument and preset the system
+        # Define measurement parameter and display the trace
+        self.pna.write(f"CALC:PAR:DEF 'Meas1', {param};:DISP:WIND:TRAC:FEED 'Meas1'")
+
+        # Configure the frequency sweep: start, stop and number of points
+        self.pna.write(f"SENS:FREQ:STAR {start_freq};STOP {stop_freq};:SENS:SWE:POIN {number_of_points}")
+
+        # Trigger the measurement and wait for the sweep to complete
+        self.pna.write("INIT:IMM")
+        self.pna.query("*OPC?")
 
-        # Configure the frequency sweep (example)
-        self.pna.write(f"SENS:FREQ:STAR {start_freq}")  # Start frequency: 1 GHz
-        self.pna.write(f"SENS:FREQ:STOP {stop_freq}")  # Stop frequency: 10 GHz
-        self.pna.write(f"SENS:SWE:POIN {number_of_points}")  # Number of points
+        if binary:
+            # Retrieve the S-parameter data as little-endian 32-bit binary block
+            self.pna.write("FORM:DATA REAL,32;:FORM:BORD SWAP")  # Binary format, swapped byte order (little-endian)
+            try:
+                sparam_data = self.pna.query_binary_values("CALC:DATA? SDATA", datatype='f', is_big_endian=False,
+                                                           container=np.ndarray)  # Get the S-parameter data
+            finally:
+                self.pna.write("FORM:DATA ASC")  # Back to ASCII for the other queries
+        else:
+            # Retrieve the S-parameter data as ASCII and parse it in one pass
+            self.pna.write("FORM:DATA ASC")  # Set the data format to ASCII
+            sparam_data = np.fromstring(self.pna.query("CALC:DATA? SDATA"), sep=',', dtype=np.float32)
 
-        # Trigger the measurement
-        self.pna.write("INIT:IMM;*WAI")
+        # Interleaved real/imaginary pairs, viewed in place as complex values
+        data_complex = sparam_data.view(np.complex64)
 
-        # Retrieve the S-parameter data
-        self.pna.write("FORM:DATA ASC")  # Set the data format to ASCII
-        sparam_data = self.pna.query("CALC:DATA? SDATA")  # Get the S-parameter data
+        # Frequency axis of the sweep
+        freqs = np.linspace(start_freq, stop_freq, number_of_points)
+        freqs_ghz = np.multiply(freqs, 1e-9, dtype=np.float64)  # Frequency in GHz for the S2P file
 
-        # Parse the data
-        data_list = [float(x) for x in sparam_data.split(',')]
-        data_complex = np.array(data_list[0::2]) + 1j * np.array(data_list[1::2])
+        real = data_complex.real.tolist()
+        imag = data_complex.imag.tolist()
 
-        # Save data to CSV
-        df = pd.DataFrame({
-            'Frequency': np.linspace(start_freq, stop_freq, number_of_points),
-            'Real': data_complex.real,
-            'Imaginary': data_complex.imag
-        })
-        df.to_csv('sparam_data.csv', index=False)
+        # Save data to CSV, the float32 data at float32 precision and the frequency at full Hz resolution
+        rows = zip(freqs.tolist(), real, imag)
+        with open('sparam_data.csv', 'w') as f:
+            f.write("Frequency,Real,Imaginary\n")  # CSV header
+            f.write("\n".join("%.12g,%.8g,%.8g" % row for row in rows) + "\n")
 
-        # Save data to S2P
+        # Save data to S2P, all rows joined and written at once
+        rows = zip(freqs_ghz.tolist(), real, imag)
         with open('sparam_data.s2p', 'w') as f:
             f.write("# GHz S MA R 50\n")  # S2P file header
-            for freq, real, imag in zip(np.linspace(start_freq, stop_freq, number_of_points), data_complex.real, data_complex.imag):
-                f.write(f"{freq / 1e9} {real} {imag}\n")  # Frequency in GHz
+            f.write("\n".join("%.12g %.8g %.8g" % row for row in rows) + "\n")
 
         print("Done writing data to the files.")
 
         return 0
 
-    def get_all_marker_data(self, file_name, trace_index):
-        marker_data = []
-        for i in range(1, 11):
+    def _fetch_channel_data(self, channels):
+        """
+        Triggers a sweep on every channel, waits once for all of them and reads back the
+        S-parameter data of each channel as a binary block
+        Holds the instance lock so concurrent get_data_output_async calls run one after another
+        """
+        with self._io_lock:
+            self.pna.write("FORM:DATA REAL,32;:FORM:BORD SWAP")
             try:
-                self.pna.write(f"CALC{trace_index}:PAR:SEL")
+                self.pna.write(";".join(f":INIT{channel}:IMM" for channel in channels))
+                self.pna.query("*OPC?")
 
-                self.pna.query(f"CALC{trace_index}:MARK{i}:X?")
-                x_data = self.pna.read()
+                channel_data = {}
+                for channel in channels:
+                    sparam_data = self.pna.query_binary_values(f"CALC{channel}:DATA? SDATA", datatype='f',
+                                                               is_big_endian=False, container=np.ndarray)
+                    channel_data[channel] = sparam_data.view(np.complex64)
+            finally:
+                self.pna.write("FORM:DATA ASC")  # Back to ASCII for the other queries
 
-                self.pna.write(f"CALC{trace_index}:MARK{i}:Y?")
-                y_data = self.pna.read()
+        return channel_data
 
-                x_data_list = [float(x) for x in x_data.split(',')]
-                y_data_list = [float(y) for y in y_data.split(',')]
+    async def get_data_output_async(self, channels):
+        """
+        channels: channel numbers to sweep and read, like [1, 2, 3]
+        Returns a dict of channel number to complex S-parameter data.
+        The VISA session is driven from a worker thread so the event loop stays free, use
+        asyncio.gather on several PNAX instances to acquire from multiple instruments at once.
+        Concurrent calls of this method on one instance run one after another, but no other
+        method of the instance may be called until the await has finished
+        """
+        channels = list(channels)
+        if not channels:
+            raise ValueError("At least one channel is required")
 
-                for x, y in zip(x_data_list, y_data_list):
-                    marker_data.append({'Marker': i, 'Trace': trace_index, 'X': x, 'Y': y})
-            except:
-                continue
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._fetch_channel_data, channels)
 
-        df = pd.DataFrame(marker_data)
-        df.to_excel(file_name, index=False)
+    def get_all_marker_data(self, file_name, trace_index):
+        marker_data = np.empty(0, dtype=self._MARKER_DTYPE)
+        try:
+            self.pna.write(f"CALC{trace_index}:PAR:SEL")
+
+            # Find the markers that are on, one compound query for all ten
+            states = self.pna.query(";".join(f":CALC{trace_index}:MARK{i}:STAT?" for i in range(1, 11))).split(';')
+            if len(states) != 10:
+                raise ValueError(f"Expected 10 marker states, got {len(states)}")
+            markers = [i for i, state in zip(range(1, 11), states) if int(state)]
+
+            # Read X and Y of every active marker, one compound query for all of them
+            if markers:
+                response = self.pna.query(";".join(f":CALC{trace_index}:MARK{i}:X?;Y?" for i in markers))
+                values = response.split(';')
+                if len(values) != 2 * len(markers):
+                    raise ValueError(f"Expected {2 * len(markers)} marker readouts, got {len(values)}")
+
+                # Converted in one pass each, a malformed number raises instead of truncating the readout
+                x_arrays = [np.array(x_data.split(','), dtype=np.float64) for x_data in values[0::2]]
+                y_arrays = [np.array(y_data.split(','), dtype=np.float64) for y_data in values[1::2]]
+                counts = [min(x.size, y.size) for x, y in zip(x_arrays, y_arrays)]
+
+                # One row per X/Y pair, allocated up front and filled column by column
+                marker_data = np.empty(sum(counts), dtype=self._MARKER_DTYPE)
+                marker_data['Marker'] = np.repeat(markers, counts)
+                marker_data['Trace'] = trace_index
+                marker_data['X'] = np.concatenate([x[:n] for x, n in zip(x_arrays, counts)])
+                marker_data['Y'] = np.concatenate([y[:n] for y, n in zip(y_arrays, counts)])
+        except (pyvisa.VisaIOError, ValueError) as e:
+            print(e.args)
+            print("Error reading marker data")
+
+        # Output format follows the file extension, anything other than .csv or .parquet is written as Excel
+        df = pd.DataFrame.from_records(marker_data)
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension == '.csv':
+            df.to_csv(file_name, index=False)
+        elif extension == '.parquet':
+            df.to_parquet(file_name, index=False)
+        else:
+            df.to_excel(file_name, index=False)
 
 
     def disconnect_pna(self):
         # Close the connection
-        self.pna.close()
+        if self.pna is not None:
+            self.pna.close()
+            self.pna = None
         return 0
 
 
@@ -262,7 +356,6 @@ if __name__ == '__main__':
     """
     The main function used to handle/call the above functions to perform necessary testing
     """
-    pnax = PNAX(ip="")  # input the IP Address
-    pnax.connect()
-    pnax.print_id()
+    with PNAX(ip="") as pnax:  # input the IP Address
+        pnax.print_id()
 